@@ -0,0 +1,284 @@
+"""Offline benchmark and load test of the exporter.
+
+The exporter runs against the fake Neo4j backend of fake_neo4j.py, no Neo4j and no network are needed.
+It reports the wall time of the collection cycles, the peak RSS, the number of series and the latency
+of rendering and serving /metrics, and compares them with a saved baseline.
+
+    python3 bench/benchmark.py --databases 500 --nodes 20 --transactions 50000 --save-baseline baseline.json
+    python3 bench/benchmark.py --databases 500 --nodes 20 --transactions 50000 --baseline baseline.json
+"""
+import argparse
+import contextlib
+import http.client
+import json
+import os
+import platform
+import resource
+import statistics
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic, sleep
+
+import fake_neo4j
+
+# Metrics compared with the baseline, True when higher is better
+COMPARED = {
+    'cycle_seconds': False,
+    'transactions_collect_seconds': False,
+    'render_seconds': False,
+    'serve_text_seconds': False,
+    'serve_gzip_seconds': False,
+    'serve_openmetrics_seconds': False,
+    'serve_not_modified_seconds': False,
+    'load_requests_per_second': True,
+    'load_p99_seconds': False,
+    'nodes_collected_min': True,
+    'peak_rss_mb': False,
+    'series': False,
+}
+# Requests of the serve benchmark: name -> headers
+SERVE_VARIANTS = {
+    'text': {},
+    'gzip': {'Accept-Encoding': 'gzip'},
+    'openmetrics': {'Accept': 'application/openmetrics-text; version=1.0.0'},
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Offline benchmark of the Neo4j exporter with a fake Neo4j backend')
+    parser.add_argument('--databases', type=int, default=500, help='Number of databases')
+    parser.add_argument('--nodes', type=int, default=20, help='Number of cluster nodes returned by SHOW SERVERS')
+    parser.add_argument('--transactions', type=int, default=50000, help='Number of running transactions in the cluster')
+    parser.add_argument('--slow-fraction', type=float, default=0.01, help='Fraction of the transactions that are slow queries')
+    parser.add_argument('--churn', type=float, default=0.5, help='Fraction of the slow queries replaced by new ones on every cycle')
+    parser.add_argument('--latency', type=float, default=0.005, help='Latency of every query in seconds')
+    parser.add_argument('--slow-nodes', type=int, default=0, help='Number of nodes answering after --slow-latency')
+    parser.add_argument('--slow-latency', type=float, default=5.0, help='Latency of the slow nodes in seconds')
+    parser.add_argument('--hanging-nodes', type=int, default=0, help='Number of nodes that never answer')
+    parser.add_argument('--cycle-timeout', type=int, default=10, help='CYCLE_TIMEOUT of the exporter in seconds')
+    parser.add_argument('--slow-query-mode', choices=('labels', 'aggregate', 'both'), default='labels', help='SLOW_QUERY_MODE of the exporter')
+    parser.add_argument('--cycles', type=int, default=5, help='Number of measured collection cycles')
+    parser.add_argument('--requests', type=int, default=200, help='Number of /metrics requests of every kind')
+    parser.add_argument('--concurrency', type=int, default=8, help='Number of concurrent clients of the load test')
+    parser.add_argument('--baseline', help='Baseline JSON file to compare the results with')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed regression against the baseline, 0.2 is 20%%')
+    parser.add_argument('--save-baseline', help='Saving the results as a baseline JSON file')
+    parser.add_argument('--verbose', action='store_true', help='Showing the logs of the exporter')
+    return parser.parse_args()
+
+
+def percentile(values, fraction):
+    """Returning the value below which the fraction of the values are"""
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def import_exporter(args):
+    """Configuring and importing the exporter with the fake backend installed"""
+    cluster = fake_neo4j.FakeCluster(databases=args.databases, nodes=args.nodes, transactions=args.transactions,
+                                     slow_fraction=args.slow_fraction, churn=args.churn, latency=args.latency,
+                                     slow_nodes=args.slow_nodes, slow_latency=args.slow_latency, hanging_nodes=args.hanging_nodes)
+    fake_neo4j.install(cluster)
+    os.environ['NEO4J_SERVICE'] = 'bench-service'
+    os.environ['CYCLE_TIMEOUT'] = str(args.cycle_timeout)
+    os.environ['SLOW_QUERY_MODE'] = args.slow_query_mode
+    # Only the first run of the scheduler is left, the measured cycles are run by the benchmark
+    for name in ('topology', 'databases', 'connections', 'page_cache', 'transactions'):
+        os.environ['COLLECT_' + name.upper() + '_INTERVAL'] = '86400'
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+    import app
+    return cluster, app
+
+
+def wait_first_run(app, timeout):
+    """Waiting for the first run of the scheduler, the topology must be known before the measured cycles"""
+    deadline = monotonic() + timeout
+    while monotonic() < deadline:
+        with app.RUNNING_FAMILIES_LOCK:
+            if not app.RUNNING_FAMILIES and len(app.FAMILY_TIMINGS) == len(app.SCHEDULE):
+                return
+        sleep(0.05)
+    raise RuntimeError('The first collection did not finish in %d seconds' % timeout)
+
+
+def healthy_nodes(app, args):
+    """Returning the number of nodes that should be collected on every cycle, the slow ones only if they answer in time"""
+    deadline = min(app.SCHEDULE['transactions']['timeout'] + app.QUERY_GRACE, app.CYCLE_DEADLINE)
+    return args.nodes - args.hanging_nodes - (args.slow_nodes if args.slow_latency >= deadline else 0)
+
+
+def bench_cycles(app, cycles):
+    """Running every family at the same time like the first run of the scheduler.
+    The nodes whose transactions made it into every cycle are counted to catch collector threads running out"""
+    durations = []
+    collect = []
+    collected = []
+    series = []
+    fan_out = app.fan_out
+
+    def counting_fan_out(query_name, *args):
+        results = fan_out(query_name, *args)
+        # The primary service queries go through fan_out() too, only the nodes of the transactions are counted
+        if query_name == 'transactions':
+            collected.append(sum(1 for result in results.values() if result is not None))
+        return results
+
+    app.fan_out = counting_fan_out
+    try:
+        for _ in range(cycles):
+            start = monotonic()
+            futures = [app.FAMILY_POOL.submit(app.run_family, name) for name in app.SCHEDULE]
+            for future in futures:
+                future.result()
+            durations.append(monotonic() - start)
+            collect.append(app.FAMILY_TIMINGS['transactions']['collect'])
+            series.append(count_series(app.SNAPSHOT['bodies']['text']))
+    finally:
+        app.fan_out = fan_out
+    return {'cycle_seconds': statistics.median(durations), 'cycle_max_seconds': max(durations),
+            'transactions_collect_seconds': statistics.median(collect),
+            'nodes_collected_min': min(collected), 'nodes_collected_max': max(collected),
+            'cycle_series_min': min(series), 'cycle_series_max': max(series),
+            'stuck_queries': len(app.STUCK_QUERIES)}
+
+
+def count_series(body):
+    """Counting the series of a metrics page"""
+    return sum(1 for line in body.splitlines() if line and not line.startswith(b'#'))
+
+
+def bench_render(app, count):
+    """Timing the rendering of the registry into a snapshot"""
+    durations = []
+    for _ in range(count):
+        start = monotonic()
+        app.render_snapshot()
+        durations.append(monotonic() - start)
+    body = app.SNAPSHOT['bodies']['text']
+    return {'render_seconds': statistics.median(durations), 'body_bytes': len(body),
+            'series': count_series(body)}
+
+
+def bench_serve(app, count):
+    """Timing /metrics in process, every kind of request is served from the same snapshot"""
+    client = app.app.test_client()
+    results = {}
+    for variant, headers in SERVE_VARIANTS.items():
+        durations = []
+        for _ in range(count):
+            start = monotonic()
+            response = client.get('/metrics', headers=headers)
+            response.get_data()
+            durations.append(monotonic() - start)
+        results['serve_' + variant + '_seconds'] = statistics.median(durations)
+        if variant == 'gzip':
+            results['gzip_bytes'] = len(response.get_data())
+            etag = response.headers['ETag']
+    durations = []
+    for _ in range(count):
+        start = monotonic()
+        response = client.get('/metrics', headers={'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+        durations.append(monotonic() - start)
+    assert response.status_code == 304, response.status_code
+    results['serve_not_modified_seconds'] = statistics.median(durations)
+    return results
+
+
+def bench_load(app, count, concurrency):
+    """Load testing /metrics over HTTP on the loopback interface with waitress while the families are collected"""
+    try:
+        from waitress import create_server
+    except ImportError:
+        return {}
+    server = create_server(app.app, host='127.0.0.1', port=0, threads=app.HTTP_THREADS)
+    threading.Thread(target=server.run, name='bench_server', daemon=True).start()
+    port = server.effective_port
+
+    def client(requests):
+        connection = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+        durations = []
+        for i in range(requests):
+            start = monotonic()
+            connection.request('GET', '/metrics', headers=SERVE_VARIANTS[list(SERVE_VARIANTS)[i % len(SERVE_VARIANTS)]])
+            response = connection.getresponse()
+            response.read()
+            durations.append(monotonic() - start)
+        connection.close()
+        return durations
+
+    # New snapshots are published during the load test like in production
+    collecting = [app.FAMILY_POOL.submit(app.run_family, name) for name in app.SCHEDULE]
+    start = monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        durations = [duration for result in pool.map(client, [count // concurrency] * concurrency) for duration in result]
+    elapsed = monotonic() - start
+    for future in collecting:
+        future.result()
+    server.close()
+    return {'load_requests_per_second': len(durations) / elapsed, 'load_p50_seconds': percentile(durations, 0.5),
+            'load_p99_seconds': percentile(durations, 0.99)}
+
+
+def compare(results, baseline, tolerance):
+    """Printing the results next to the baseline, returns the regressed metrics"""
+    regressions = []
+    print('%-32s %14s %14s %9s' % ('metric', 'baseline', 'current', 'delta'))
+    for name, value in results.items():
+        if name not in baseline:
+            print('%-32s %14s %14.6g' % (name, '-', value))
+            continue
+        delta = (value - baseline[name]) / baseline[name] if baseline[name] else 0.0
+        regressed = name in COMPARED and (-delta if COMPARED[name] else delta) > tolerance
+        if regressed:
+            regressions.append(name)
+        print('%-32s %14.6g %14.6g %+8.1f%%%s' % (name, baseline[name], value, delta * 100, '  REGRESSION' if regressed else ''))
+    return regressions
+
+
+def main():
+    args = parse_args()
+    # The exporter logs every query, they are hidden unless --verbose
+    logs = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(open(os.devnull, 'w'))
+    with logs:
+        cluster, app = import_exporter(args)
+        try:
+            wait_first_run(app, args.cycle_timeout + args.slow_latency + 60)
+            results = bench_cycles(app, args.cycles)
+            expected_nodes = healthy_nodes(app, args)
+            results.update(bench_render(app, max(args.requests // 10, 1)))
+            results.update(bench_serve(app, args.requests))
+            results.update(bench_load(app, args.requests, args.concurrency))
+            # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+            results['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 * 1024 if platform.system() == 'Darwin' else 1024)
+        finally:
+            # The hanging nodes answer now, their workers finish before the logs are restored
+            cluster.release()
+            app.COLLECTOR_POOL.shutdown(wait=True)
+
+    parameters = {name: value for name, value in vars(args).items() if name not in ('baseline', 'tolerance', 'save_baseline', 'verbose')}
+    print('Parameters: ' + ', '.join('%s=%s' % item for item in parameters.items()))
+    # Every node that answers in time must be collected on every cycle, whatever the hanging ones do
+    failed = results['nodes_collected_min'] < expected_nodes
+    if failed:
+        print('FAILED: a cycle collected %d of the %d nodes that answer in time' % (results['nodes_collected_min'], expected_nodes))
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump({'parameters': parameters, 'results': results}, f, indent=2, sort_keys=True)
+    if not args.baseline:
+        for name, value in results.items():
+            print('%-32s %14.6g' % (name, value))
+        return 1 if failed else 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline['parameters'] != parameters:
+        print('Warning: the baseline was run with other parameters: ' + json.dumps(baseline['parameters'], sort_keys=True))
+    regressions = compare(results, baseline['results'], args.tolerance)
+    if regressions:
+        print('Regressed by more than %d%%: %s' % (args.tolerance * 100, ', '.join(regressions)))
+        return 1
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
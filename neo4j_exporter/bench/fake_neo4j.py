@@ -0,0 +1,146 @@
+"""Fake Neo4j driver for the offline benchmark.
+
+It answers the queries of the exporter with synthetic result sets of a configurable size
+and latency, without any network. Nodes can be made slow or hanging to exercise the deadlines.
+"""
+import random
+import threading
+from time import sleep
+
+import neo4j
+
+
+class FakeRecord(dict):
+    """A record as returned by the Neo4j driver"""
+
+    def data(self):
+        return dict(self)
+
+
+class FakeCluster:
+    """Synthetic cluster: databases, nodes and the transactions running on every node"""
+
+    def __init__(self, databases=500, nodes=20, transactions=50000, slow_fraction=0.01, churn=0.5,
+                 connections=200, latency=0.005, slow_nodes=0, slow_latency=5.0, hanging_nodes=0,
+                 threshold=10000, seed=42):
+        rnd = random.Random(seed)
+        self.latency = latency
+        self.slow_latency = slow_latency
+        self.threshold = threshold
+        self.databases = ['tenant%04d' % i for i in range(databases)]
+        self.nodes = ['bench-node-%d.bench' % i for i in range(nodes)]
+        self.slow_hosts = set(self.nodes[:slow_nodes])
+        self.hanging_hosts = set(self.nodes[len(self.nodes) - hanging_nodes:]) if hanging_nodes else set()
+        # Hanging nodes wait on it, it's set by release() so the worker threads can exit
+        self.released = threading.Event()
+        self.calls = {}
+        self.calls_lock = threading.Lock()
+        self.connections = [FakeRecord(connector=connector, count=count) for connector, count in
+                            (('bolt', connections * 3 // 4), ('http', connections - connections * 3 // 4))]
+        self.database_records = [FakeRecord(name=name, address=self.nodes[i % len(self.nodes)] + ':7687' if self.nodes else 'bench-service:7687',
+                                            currentStatus='online' if i % 50 else 'offline', store='block-block-1.1')
+                                 for i, name in enumerate(self.databases)]
+
+        # Transactions of every node aggregated by database, like the server does
+        self.node_transactions = {}
+        per_node = transactions // max(len(self.nodes), 1)
+        for host in self.nodes + ['bench-service']:
+            counts = {}
+            slow = []
+            for tx_id in range(per_node):
+                database = self.databases[rnd.randrange(len(self.databases))]
+                counts[database] = counts.get(database, 0) + 1
+                if rnd.random() < slow_fraction:
+                    slow.append((database, tx_id))
+            self.node_transactions[host] = {'counts': counts, 'slow': slow, 'max_id': per_node, 'churn': int(len(slow) * churn)}
+
+    def release(self):
+        """Letting the hanging nodes answer"""
+        self.released.set()
+
+    def call(self, host, closed):
+        """Counting the calls to a node and waiting for its latency.
+        Hanging nodes answer once released, or fail once their driver is closed like a shut down socket"""
+        with self.calls_lock:
+            self.calls[host] = self.calls.get(host, 0) + 1
+            generation = self.calls[host]
+        if host in self.hanging_hosts:
+            while not self.released.wait(0.05):
+                if closed.is_set():
+                    raise neo4j.exceptions.ServiceUnavailable('Connection to ' + host + ' closed while waiting for the result')
+        elif host in self.slow_hosts:
+            sleep(self.slow_latency)
+        elif self.latency:
+            sleep(self.latency)
+        return generation
+
+    def show_transactions(self, host, generation):
+        """SHOW TRANSACTIONS aggregated by database, a part of the slow transactions is replaced on every call"""
+        node = self.node_transactions.get(host, self.node_transactions['bench-service'])
+        slow_queries = {}
+        for i, (database, tx_id) in enumerate(node['slow']):
+            if i < node['churn']:
+                tx_id += node['max_id'] * generation
+            slow_queries.setdefault(database, []).append({
+                'database': database, 'transactionId': '%s-transaction-%d' % (database, tx_id),
+                'currentQueryId': 'query-%d' % tx_id, 'status': 'Running', 'activeLockCount': tx_id % 7,
+                'pageHits': 1000 * generation + tx_id % 1000, 'elapsedTimeMillis': self.threshold + 1000 * generation + tx_id % 50000,
+                'cpuTimeMillis': tx_id % 20000, 'waitTimeMillis': tx_id % 3000, 'idleTimeSeconds': tx_id % 60,
+            })
+        return [FakeRecord(database=database, txCount=count, maxId=node['max_id'] * generation, slowQueries=slow_queries.get(database, []))
+                for database, count in node['counts'].items()]
+
+    def run(self, host, query, closed):
+        """Answering a query sent to a node"""
+        generation = self.call(host, closed)
+        if 'SHOW SERVERS' in query:
+            return [FakeRecord(address=node + ':7687') for node in self.nodes]
+        if 'SHOW DATABASES' in query:
+            return self.database_records
+        if 'SHOW TRANSACTIONS' in query:
+            return self.show_transactions(host, generation)
+        if 'listConnections' in query:
+            return self.connections
+        # JMX and the routing table are missing like on Community Edition
+        raise neo4j.exceptions.ClientError('Unsupported by the fake backend: ' + query[:60])
+
+
+class FakeSession:
+    """Session bound to one node of the fake cluster"""
+
+    def __init__(self, cluster, host, closed):
+        self.cluster = cluster
+        self.host = host
+        self.closed = closed
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        pass
+
+    def run(self, query, *args, **kwargs):
+        return self.cluster.run(self.host, getattr(query, 'text', query), self.closed)
+
+
+class FakeDriver:
+    """Driver returned by GraphDatabase.driver() while the fake backend is installed"""
+
+    def __init__(self, cluster, uri):
+        self.cluster = cluster
+        self.host = uri.split('//', 1)[1].rsplit(':', 1)[0]
+        self.closed = threading.Event()
+
+    def session(self, **kwargs):
+        return FakeSession(self.cluster, self.host, self.closed)
+
+    def close(self):
+        self.closed.set()
+
+
+def install(cluster):
+    """Replacing GraphDatabase.driver with the fake backend, must be called before the exporter is imported"""
+    neo4j.GraphDatabase.driver = staticmethod(lambda uri, **kwargs: FakeDriver(cluster, uri))
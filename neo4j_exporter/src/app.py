@@ -1,28 +1,76 @@
-import pickle
-from multiprocessing import Process
-from time import gmtime, strftime
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import gzip
+from time import gmtime, strftime, monotonic, sleep, time
 import os
+import random
 import threading
 import traceback
 import prometheus_client
 from prometheus_client.core import CollectorRegistry
-from prometheus_client import Gauge, Counter
-from neo4j import GraphDatabase
+from prometheus_client import Gauge, Counter, Histogram
+from prometheus_client.openmetrics import exposition as openmetrics
+from neo4j import GraphDatabase, Query
+from neo4j.exceptions import Neo4jError
 import urllib3
-from flask import Response, Flask
+from flask import Response, Flask, jsonify, request
 
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+# The *_created series double the number of series of the counters and histograms
+prometheus_client.disable_created_metrics()
 
 CONTENT_TYPE_LATEST = str('text/plain; version=0.0.4; charset=utf-8')
 SERVICE_URL = os.environ.get('NEO4J_SERVICE')
 PREFIX = "neo4j_"
-PROM_OUTPUT = []
-BACKGROUND_CHECK = False
-FLASK_FIRST_LAUNCH = True
-NEO4J_DRIVER = None
+# The last rendered metrics page in both formats, replaced as a whole and never changed once published.
+# The gzip-compressed bodies are added the first time they are requested
+SNAPSHOT = {'serial': 0, 'time': 0.0, 'bodies': {'text': b'', 'openmetrics': b''}, 'gzip': {}, 'lock': threading.Lock()}
+# Long-lived drivers of the primary service and the cluster nodes, {(query, address): (uri, driver)}.
+# Every query has its own, closing the connections of a query that doesn't answer leaves the other queries alone
+NEO4J_DRIVERS = {}
+NEO4J_DRIVERS_LOCK = threading.Lock()
+# Queries still running on the collector pool, {(query, address): future}, a node gets one query at a time
+IN_FLIGHT = {}
+# Queries of IN_FLIGHT that missed their deadline, their node is skipped until they return
+STUCK_QUERIES = set()
+IN_FLIGHT_LOCK = threading.Lock()
+# Cluster nodes read from Neo4j by the topology family, {address: host:port}, replaced as a whole
+TOPOLOGY = {'nodes': {}, 'time': 0.0, 'source': None}
+# Set once the topology has been read for the first time, successfully or not, the transactions wait for it
+TOPOLOGY_READY = threading.Event()
+# Discovery source of the nodes of the last transactions run
+NODES_SOURCE = None
 
 # Query timeout in seconds
 QUERY_TIMEOUT = int(os.environ.get('QUERY_TIMEOUT', '30'))
+# Time in seconds given to Neo4j to abort a query on its own before the exporter closes its connections
+QUERY_GRACE = int(os.environ.get('QUERY_GRACE', '5'))
+# Deadline for collecting transactions from all the nodes in seconds, capped to the interval of the transactions family
+# so that a slow node doesn't make the next runs be skipped
+CYCLE_TIMEOUT = int(os.environ.get('CYCLE_TIMEOUT', '25'))
+# Number of nodes queried in parallel
+COLLECTOR_WORKERS = int(os.environ.get('COLLECTOR_WORKERS', '8'))
+# Maximum number of Bolt connections kept open per node
+NEO4J_POOL_SIZE = int(os.environ.get('NEO4J_POOL_SIZE', '5'))
+# Idle time in seconds after which a pooled connection is checked before being reused
+NEO4J_LIVENESS_CHECK = int(os.environ.get('NEO4J_LIVENESS_CHECK', '60'))
+# Queries running for longer than this number of milliseconds are reported as slow
+SLOW_QUERY_THRESHOLD = int(os.environ.get('SLOW_QUERY_THRESHOLD', '10000'))
+# How slow queries are exported: labels (a series per transaction), aggregate (histograms and counters) or both
+SLOW_QUERY_MODE = os.environ.get('SLOW_QUERY_MODE', 'labels').lower()
+if SLOW_QUERY_MODE not in ('labels', 'aggregate', 'both'):
+    print (strftime("%Y-%m-%d %H:%M:%S", gmtime()) + ' [WARN] Unknown SLOW_QUERY_MODE ' + SLOW_QUERY_MODE + ', expected labels, aggregate or both, using labels')
+    SLOW_QUERY_MODE = 'labels'
+# Number of the slowest queries exported with their transaction id in the aggregate mode, 0 disables it
+SLOW_QUERY_TOP_N = int(os.environ.get('SLOW_QUERY_TOP_N', '10'))
+# Port and number of threads of the web server
+HTTP_PORT = int(os.environ.get('HTTP_PORT', '5000'))
+HTTP_THREADS = int(os.environ.get('HTTP_THREADS', '16'))
+# Time in seconds the cluster topology read from Neo4j is used for, after that the environment variables are used
+TOPOLOGY_TTL = int(os.environ.get('TOPOLOGY_TTL', '900'))
+# Enables the /debug/timings page with the timings of the last collections
+PROFILING_ENDPOINT = os.environ.get('PROFILING_ENDPOINT', 'false').lower() in ('1', 'true', 'yes')
+
+COLLECTOR_POOL = ThreadPoolExecutor(max_workers=COLLECTOR_WORKERS, thread_name_prefix='collector')
 
 try:
     with open('/var/run/secrets/kubernetes.io/serviceaccount/namespace', encoding="utf-8") as f_file:
@@ -32,256 +80,520 @@ except Exception:
 
 app = Flask(import_name=__name__)
 
-def background_collector():
-    """Collecting Neo4j metrics in the background"""
-    global FLASK_FIRST_LAUNCH
-
-    if FLASK_FIRST_LAUNCH is True:
-        print(strftime("%Y-%m-%d %H:%M:%S", gmtime()) + ' [INFO] Waiting for the web-server to start')
-        FLASK_FIRST_LAUNCH = False
-        threading.Timer(60, background_collector).start()
-        print(strftime("%Y-%m-%d %H:%M:%S", gmtime()) + ' [INFO] The task of background collection of metrics has been successfully created')
-    else:
-        global BACKGROUND_CHECK
-        if BACKGROUND_CHECK is True:
-            print(strftime("%Y-%m-%d %H:%M:%S", gmtime()) + ' [WARN] Another background collector is already running, skipping the current run')
-        else:
-            BACKGROUND_CHECK = True
-            print(strftime("%Y-%m-%d %H:%M:%S", gmtime()) + ' [INFO] Start background collecting Prometheus metrics')
-            lst = []
-            registry = CollectorRegistry()
-
-            ### Database statuses ###
-            neo4j_db_status = Gauge('neo4j_db_status', 'List of all databases with their status. 1 – online, 0 – all other statuses', ['name', 'address', 'currentStatus', 'namespace'], registry=registry)
-
-            ### Transaction metrics ###
-            neo4j_transaction_active = Gauge('neo4j_transaction_active', 'Number of currently active transactions', ['database', 'namespace'], registry=registry)
-            neo4j_transaction_last_id = Gauge('neo4j_transaction_last_id', 'Last transaction ID seen', ['database', 'namespace'], registry=registry)
-
-            ### Connection metrics ###
-            neo4j_bolt_connections_active = Gauge('neo4j_bolt_connections_active', 'Number of active bolt connections', ['connector', 'namespace'], registry=registry)
-            neo4j_bolt_connections_total = Gauge('neo4j_bolt_connections_total', 'Total number of bolt connections', ['namespace'], registry=registry)
-
-            ### Page cache metrics (Enterprise/JMX only - may be empty) ###
-            neo4j_page_cache_hits = Gauge('neo4j_page_cache_hits', 'Total page cache hits (Enterprise only)', ['database', 'namespace'], registry=registry)
-            neo4j_page_cache_faults = Gauge('neo4j_page_cache_faults', 'Total page cache faults (Enterprise only)', ['database', 'namespace'], registry=registry)
-            neo4j_page_cache_hit_ratio = Gauge('neo4j_page_cache_hit_ratio', 'Page cache hit ratio (Enterprise only)', ['database', 'namespace'], registry=registry)
-
-            ### Store format info ###
-            neo4j_store_format = Gauge('neo4j_store_format', 'Store format version (1=current, 0=other)', ['database', 'format', 'namespace'], registry=registry)
-
-            print (strftime("%Y-%m-%d %H:%M:%S", gmtime()) + ' [INFO] [-] Getting the statuses of all tables in the cluster')
+# The registry lives for the whole run, the collector updates its metrics in place
+REGISTRY = CollectorRegistry()
+# Label sets set by the last cycle for every gauge, used to remove the series that are gone
+GAUGE_SERIES = {}
+
+### Database statuses ###
+neo4j_db_status = Gauge('neo4j_db_status', 'List of all databases with their status. 1 – online, 0 – all other statuses', ['name', 'address', 'currentStatus', 'namespace'], registry=REGISTRY)
+
+### Transaction metrics ###
+neo4j_transaction_active = Gauge('neo4j_transaction_active', 'Number of currently active transactions', ['database', 'namespace'], registry=REGISTRY)
+neo4j_transaction_last_id = Gauge('neo4j_transaction_last_id', 'Last transaction ID seen', ['database', 'namespace'], registry=REGISTRY)
+
+### Connection metrics ###
+neo4j_bolt_connections_active = Gauge('neo4j_bolt_connections_active', 'Number of active bolt connections', ['connector', 'namespace'], registry=REGISTRY)
+neo4j_bolt_connections_total = Gauge('neo4j_bolt_connections_total', 'Total number of bolt connections', ['namespace'], registry=REGISTRY)
+
+### Page cache metrics (Enterprise/JMX only - may be empty) ###
+neo4j_page_cache_hits = Gauge('neo4j_page_cache_hits', 'Total page cache hits (Enterprise only)', ['database', 'namespace'], registry=REGISTRY)
+neo4j_page_cache_faults = Gauge('neo4j_page_cache_faults', 'Total page cache faults (Enterprise only)', ['database', 'namespace'], registry=REGISTRY)
+neo4j_page_cache_hit_ratio = Gauge('neo4j_page_cache_hit_ratio', 'Page cache hit ratio (Enterprise only)', ['database', 'namespace'], registry=REGISTRY)
+
+### Store format info ###
+neo4j_store_format = Gauge('neo4j_store_format', 'Store format version (1=current, 0=other)', ['database', 'format', 'namespace'], registry=REGISTRY)
+
+### Long-running queries ###
+neo4j_db_slow_queries = Gauge('neo4j_db_slow_query', f'Queries that have been running for more than {SLOW_QUERY_THRESHOLD:,} milliseconds', ['database', 'transactionId', 'currentQueryId', 'status', 'activeLockCount', 'pageHits', 'cpuTimeMillis', 'waitTimeMillis', 'idleTimeSeconds', 'namespace', 'address'], registry=REGISTRY)
+neo4j_db_slow_queries_page_hits = Gauge('neo4j_db_slow_query_page_hits', f'Page hits amount of queries that have been running for more than {SLOW_QUERY_THRESHOLD:,} milliseconds', ['database', 'transactionId', 'currentQueryId', 'status', 'activeLockCount', 'cpuTimeMillis', 'waitTimeMillis', 'idleTimeSeconds', 'namespace', 'address'], registry=REGISTRY)
+
+### Long-running queries, aggregate mode ###
+SLOW_QUERY_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600, float('inf'))
+neo4j_db_slow_query_elapsed = Histogram('neo4j_db_slow_queries_elapsed_seconds', 'Elapsed time of finished slow queries', ['database', 'namespace', 'address'], buckets=SLOW_QUERY_BUCKETS, registry=REGISTRY)
+neo4j_db_slow_query_cpu = Histogram('neo4j_db_slow_queries_cpu_seconds', 'CPU time of finished slow queries', ['database', 'namespace', 'address'], buckets=SLOW_QUERY_BUCKETS, registry=REGISTRY)
+neo4j_db_slow_query_wait = Histogram('neo4j_db_slow_queries_wait_seconds', 'Wait time of finished slow queries', ['database', 'namespace', 'address'], buckets=SLOW_QUERY_BUCKETS, registry=REGISTRY)
+neo4j_db_slow_query_page_hits_total = Counter('neo4j_db_slow_queries_page_hits', 'Page hits made by slow queries', ['database', 'namespace', 'address'], registry=REGISTRY)
+neo4j_db_slow_query_locks_total = Counter('neo4j_db_slow_queries_locks', 'Locks held by slow queries, counted once per query when it finishes', ['database', 'namespace', 'address'], registry=REGISTRY)
+neo4j_db_slow_query_top = Gauge('neo4j_db_slow_queries_top', 'Elapsed time in milliseconds of the slowest running queries, limited to SLOW_QUERY_TOP_N series', ['database', 'transactionId', 'currentQueryId', 'status', 'namespace', 'address'], registry=REGISTRY)
+# Slow queries seen running by the last cycle, {(address, database, transactionId): row}
+SLOW_QUERY_RUNNING = {}
+
+### Exporter self-monitoring ###
+EXPORTER_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, float('inf'))
+neo4j_exporter_collection_duration = Histogram('neo4j_exporter_collection_duration_seconds', 'Duration of the collection of a metric family', ['family'], buckets=EXPORTER_BUCKETS, registry=REGISTRY)
+neo4j_exporter_query_duration = Histogram('neo4j_exporter_query_duration_seconds', 'Duration of the Neo4j queries by query and node', ['query', 'address'], buckets=EXPORTER_BUCKETS, registry=REGISTRY)
+neo4j_exporter_query_timeouts = Counter('neo4j_exporter_query_timeouts', 'Neo4j queries that timed out or missed the collection deadline', ['query'], registry=REGISTRY)
+neo4j_exporter_query_errors = Counter('neo4j_exporter_query_errors', 'Neo4j queries that failed', ['query'], registry=REGISTRY)
+neo4j_exporter_skipped_nodes = Counter('neo4j_exporter_skipped_nodes', 'Nodes skipped because their previous query is still running', ['query'], registry=REGISTRY)
+neo4j_exporter_stuck_queries = Gauge('neo4j_exporter_stuck_queries', 'Queries that missed their deadline and are still holding a collector thread', registry=REGISTRY)
+neo4j_exporter_stuck_queries.set_function(lambda: len(STUCK_QUERIES))
+neo4j_exporter_skipped_runs = Counter('neo4j_exporter_skipped_runs', 'Collections skipped because the previous one of the same family was still running', ['family'], registry=REGISTRY)
+neo4j_exporter_cluster_nodes = Gauge('neo4j_exporter_cluster_nodes', 'Number of nodes the transactions are collected from by discovery source', ['source'], registry=REGISTRY)
+neo4j_exporter_snapshot_timestamp = Gauge('neo4j_exporter_snapshot_timestamp_seconds', 'Unix time when the metrics page was rendered', registry=REGISTRY)
+# The age is computed when the page is served, it lives outside of the pre-rendered registry
+SNAPSHOT_REGISTRY = CollectorRegistry()
+neo4j_exporter_snapshot_age = Gauge('neo4j_exporter_snapshot_age_seconds', 'Age of the served metrics', registry=SNAPSHOT_REGISTRY)
+neo4j_exporter_snapshot_age.set_function(lambda: time() - SNAPSHOT['time'])
+# Timings of the last run of every family and query, served by /debug/timings
+FAMILY_TIMINGS = {}
+QUERY_TIMINGS = {}
+TIMINGS_LOCK = threading.Lock()
+
+def get_driver(name, db_adress, host):
+    """Returning the long-lived driver of a query on a node, reconnecting when the node address has changed.
+    The host may include the Bolt port, 7687 is used otherwise"""
+    uri = "bolt://"+host if ':' in host else "bolt://"+host+":7687"
+    stale_driver = None
+    with NEO4J_DRIVERS_LOCK:
+        if (name, db_adress) in NEO4J_DRIVERS:
+            if NEO4J_DRIVERS[(name, db_adress)][0] == uri:
+                return NEO4J_DRIVERS[(name, db_adress)][1]
+            print (strftime("%Y-%m-%d %H:%M:%S", gmtime()) + ' [INFO] The address of ' + db_adress + ' has changed to ' + host + ', reconnecting')
+            stale_driver = NEO4J_DRIVERS[(name, db_adress)][1]
+        driver = GraphDatabase.driver(uri, auth=None, max_connection_pool_size=NEO4J_POOL_SIZE, liveness_check_timeout=NEO4J_LIVENESS_CHECK, connection_timeout=QUERY_TIMEOUT, connection_acquisition_timeout=QUERY_TIMEOUT)
+        NEO4J_DRIVERS[(name, db_adress)] = (uri, driver)
+    if stale_driver is not None:
+        stale_driver.close()
+    return driver
+
+def prune_drivers(active_addresses):
+    """Closing the drivers of the nodes that have disappeared from the cluster and dropping their query timings"""
+    with TIMINGS_LOCK:
+        stale_timings = [key for key in QUERY_TIMINGS if key.split('@', 1)[1] not in active_addresses]
+        for key in stale_timings:
+            del QUERY_TIMINGS[key]
+    for key in stale_timings:
+        try:
+            neo4j_exporter_query_duration.remove(*key.split('@', 1))
+        except KeyError:
+            pass
+    with NEO4J_DRIVERS_LOCK:
+        stale = [key for key in NEO4J_DRIVERS if key[1] not in active_addresses]
+        stale_drivers = [NEO4J_DRIVERS.pop(key)[1] for key in stale]
+    for db_adress in sorted({key[1] for key in stale}):
+        print (strftime("%Y-%m-%d %H:%M:%S", gmtime()) + ' [INFO] ' + db_adress + ' is no longer in the cluster, closing its connections')
+    for driver in stale_drivers:
+        try:
+            driver.close()
+        except Exception as e:
+            print (strftime("%Y-%m-%d %H:%M:%S", gmtime()) + ' [ERROR] Error closing the driver: ' + str(e))
+
+def reset_driver(name, db_adress):
+    """Closing the driver of a query on a node that doesn't answer, its sockets are shut down so the blocked query fails.
+    The next run of the query opens a new driver, the other queries to the node keep their connections"""
+    with NEO4J_DRIVERS_LOCK:
+        driver = NEO4J_DRIVERS.pop((name, db_adress), (None, None))[1]
+    if driver is None:
+        return
+    print (strftime("%Y-%m-%d %H:%M:%S", gmtime()) + ' [WARN] ' + db_adress + ' did not answer the ' + name + ' query in time, closing its connections')
+    try:
+        driver.close()
+    except Exception as e:
+        print (strftime("%Y-%m-%d %H:%M:%S", gmtime()) + ' [ERROR] Error closing the driver: ' + str(e))
+
+def run_query(db_adress, host, name, query, timeout=None, log_errors=True):
+    """Running a query in-process on the node and returning its records as dicts.
+    The server aborts the transaction after the timeout, in that case or on any error None is returned
+    so that a missing result can't be mistaken for an empty one"""
+    if timeout is None:
+        timeout = QUERY_TIMEOUT
+    outcome = 'error'
+    start = monotonic()
+    driver = None
+    try:
+        driver = get_driver(name, db_adress, host)
+        with driver.session() as session:
+            result = session.run(Query(query, timeout))
+            records = [record.data() for record in result]
+        outcome = 'ok'
+        return records
+    except Neo4jError as e:
+        if e.code and 'TransactionTimedOut' in e.code:
+            outcome = 'timeout'
+            if log_errors:
+                print (strftime("%Y-%m-%d %H:%M:%S", gmtime()) + ' [WARN] The ' + name + ' query timed out after ' + str(timeout) + ' seconds')
+        elif log_errors:
+            print (strftime("%Y-%m-%d %H:%M:%S", gmtime()) + ' [ERROR] Error running the ' + name + ' query: ' + str(e))
+    except Exception as e:
+        with NEO4J_DRIVERS_LOCK:
+            closed = driver is not None and NEO4J_DRIVERS.get((name, db_adress), (None, None))[1] is not driver
+        if closed:
+            # reset_driver() has closed the connections after the deadline, the timeout is already counted by fan_out()
+            outcome = 'deadline'
+            print (strftime("%Y-%m-%d %H:%M:%S", gmtime()) + ' [WARN] The ' + name + ' query on ' + db_adress + ' was aborted by the exporter after its deadline')
+        elif log_errors:
+            print (strftime("%Y-%m-%d %H:%M:%S", gmtime()) + ' [ERROR] Error running the ' + name + ' query: ' + str(e))
+            print (strftime("%Y-%m-%d %H:%M:%S", gmtime()) + ' [ERROR] ' + traceback.format_exc())
+    finally:
+        duration = monotonic() - start
+        neo4j_exporter_query_duration.labels(name, db_adress).observe(duration)
+        if outcome == 'timeout':
+            neo4j_exporter_query_timeouts.labels(name).inc()
+        elif outcome == 'error':
+            neo4j_exporter_query_errors.labels(name).inc()
+        with TIMINGS_LOCK:
+            QUERY_TIMINGS[name + '@' + db_adress] = {'finished': time(), 'duration': duration, 'outcome': outcome}
+    return None
+
+def update_gauge(gauge, samples):
+    """Updating the gauge in place from {label values: value} and removing the label sets that are gone"""
+    label_sets = set()
+    for label_values, value in samples.items():
+        label_values = tuple(str(label) for label in label_values)
+        try:
+            value = float(value)
+        except (TypeError, ValueError) as e:
+            print (strftime("%Y-%m-%d %H:%M:%S", gmtime()) + ' [ERROR] Invalid value for ' + gauge._name + ': ' + str(e))
+            continue
+        gauge.labels(*label_values).set(value)
+        label_sets.add(label_values)
+    for label_values in GAUGE_SERIES.get(gauge, set()) - label_sets:
+        gauge.remove(*label_values)
+    GAUGE_SERIES[gauge] = label_sets
+
+def observe_finished_slow_query(db_adress, db_list):
+    """Adding a slow query that is no longer running to the aggregate metrics"""
+    labels = (db_list['database'], POD_NAMESPACE, db_adress)
+    neo4j_db_slow_query_elapsed.labels(*labels).observe(db_list['elapsedTimeMillis'] / 1000)
+    if db_list['cpuTimeMillis'] is not None:
+        neo4j_db_slow_query_cpu.labels(*labels).observe(db_list['cpuTimeMillis'] / 1000)
+    if db_list['waitTimeMillis'] is not None:
+        neo4j_db_slow_query_wait.labels(*labels).observe(db_list['waitTimeMillis'] / 1000)
+    neo4j_db_slow_query_locks_total.labels(*labels).inc(db_list['activeLockCount'] or 0)
+
+def update_slow_query_aggregates(node_slow_queries, renamed=False):
+    """Updating the aggregate slow query metrics from {address: slow queries or None if the node didn't answer},
+    their cardinality only depends on the databases and nodes.
+    Queries are observed by the histograms once they finish, page hits are counted as they grow.
+    renamed is set when the nodes come from another discovery source than in the last run"""
+    running = {}
+    for db_adress, node_result in node_slow_queries.items():
+        if node_result is None:
+            # The node didn't answer, its queries are kept until it does
+            running.update({key: db_list for key, db_list in SLOW_QUERY_RUNNING.items() if key[0] == db_adress})
+            continue
+        for db_list in node_result:
+            key = (db_adress, db_list['database'], db_list['transactionId'])
+            previous_page_hits = SLOW_QUERY_RUNNING[key]['pageHits'] if key in SLOW_QUERY_RUNNING else 0
+            neo4j_db_slow_query_page_hits_total.labels(db_list['database'], POD_NAMESPACE, db_adress).inc(max((db_list['pageHits'] or 0) - (previous_page_hits or 0), 0))
+            running[key] = db_list
+        for key, db_list in SLOW_QUERY_RUNNING.items():
+            if key[0] == db_adress and key not in running:
+                observe_finished_slow_query(db_adress, db_list)
+    # The queries of the nodes that left the cluster won't be seen again, they are observed as finished.
+    # With another discovery source the nodes were only renamed, their queries are still running and are dropped
+    for key, db_list in SLOW_QUERY_RUNNING.items():
+        if key[0] not in node_slow_queries and not renamed:
+            observe_finished_slow_query(key[0], db_list)
+    SLOW_QUERY_RUNNING.clear()
+    SLOW_QUERY_RUNNING.update(running)
+
+    top = sorted(running.items(), key=lambda item: item[1]['elapsedTimeMillis'], reverse=True)[:SLOW_QUERY_TOP_N]
+    update_gauge(neo4j_db_slow_query_top, {(db_list['database'], db_list['transactionId'], db_list['currentQueryId'], db_list['status'], POD_NAMESPACE, db_adress): db_list['elapsedTimeMillis'] for (db_adress, _, _), db_list in top})
+
+def node_name(host):
+    """Naming a node after the first label of its hostname like the addresses of neo4j_db_status, IPs are kept whole"""
+    hostname = host.rsplit(':', 1)[0]
+    if hostname.replace('.', '').isdigit():
+        return hostname
+    return hostname.split('.')[0].lower()
+
+def collect_topology(timeout):
+    """Reading the cluster nodes from Neo4j: SHOW SERVERS, or the routing table on versions without it.
+    The previous topology is kept until it expires when Neo4j can't be asked"""
+    global TOPOLOGY
+    source = 'servers'
+    result = query_service('servers', 'SHOW SERVERS YIELD address', timeout, log_errors=False)
+    if not result:
+        source = 'routing_table'
+        result = query_service('routing_table', 'CALL dbms.routing.getRoutingTable({}) YIELD servers UNWIND servers AS server UNWIND server.addresses AS address RETURN DISTINCT address', timeout, log_errors=False)
+    if result is None:
+        print (strftime("%Y-%m-%d %H:%M:%S", gmtime()) + ' [WARN] Error reading the cluster topology from ' + SERVICE_URL)
+        TOPOLOGY_READY.set()
+        return
+    nodes = {node_name(record['address']): record['address'] for record in result if record['address']}
+    # A single server is the one behind the primary service, its advertised address may not be reachable from here
+    if len(nodes) < 2:
+        nodes = {}
+    if nodes != TOPOLOGY['nodes']:
+        print (strftime("%Y-%m-%d %H:%M:%S", gmtime()) + ' [INFO] Cluster topology: ' + (', '.join(sorted(nodes)) or 'single server'))
+    TOPOLOGY = {'nodes': nodes, 'time': monotonic(), 'source': source}
+    TOPOLOGY_READY.set()
+
+def discover_nodes():
+    """Finding cluster nodes from the environment variables, returns {address: host}"""
+    nodes = {}
+    for key, value in os.environ.items():
+        if ("NEO4J_CORE" in key or "NEO4J_REPLICA" in key) and "PORT_7687_TCP_ADDR" in key and not "ADMIN" in key:
+            db_adress = key.split('_')[0] + '-' + key.split('_')[1] + '-' + key.split('_')[2]
+            nodes[db_adress.lower()] = str(value)
+    return nodes
+
+def run_task(started, func, args):
+    """Running a task of fan_out(), the time it starts at is recorded for its own deadline"""
+    started.append(monotonic())
+    return func(*args)
+
+def task_finished(key, future):
+    """Forgetting a query of fan_out() once it has returned"""
+    with IN_FLIGHT_LOCK:
+        if IN_FLIGHT.get(key) is future:
+            del IN_FLIGHT[key]
+            STUCK_QUERIES.discard(key)
+
+def fan_out(query_name, tasks, task_timeout, deadline):
+    """Running {address: (function, args)} tasks of a query on the collector pool, one at a time per node.
+    Every task has task_timeout seconds from when it starts and none is waited for past the deadline (monotonic time),
+    task_timeout should leave QUERY_GRACE seconds to Neo4j to abort the query on its own.
+    The connections of the nodes that miss it are closed to unblock their thread, a node whose previous task
+    is still running is skipped. Returns {address: result} of the tasks finished in time"""
+    futures = {}
+    for db_adress, (func, args) in tasks.items():
+        key = (query_name, db_adress)
+        with IN_FLIGHT_LOCK:
+            if key in IN_FLIGHT:
+                neo4j_exporter_skipped_nodes.labels(query_name).inc()
+                print (strftime("%Y-%m-%d %H:%M:%S", gmtime()) + ' [WARN] The previous ' + query_name + ' query on ' + db_adress + ' is still running, skipping the node')
+                continue
+            started = []
+            future = COLLECTOR_POOL.submit(run_task, started, func, args)
+            IN_FLIGHT[key] = future
+        future.add_done_callback(lambda future, key=key: task_finished(key, future))
+        futures[future] = (db_adress, started)
+    pending = set(futures)
+    results = {}
+    while pending:
+        now = monotonic()
+        # Tasks still waiting for a worker only have the deadline of the cycle
+        deadlines = {future: min(futures[future][1][0] + task_timeout, deadline) if futures[future][1] else deadline for future in pending}
+        for future in [future for future in pending if deadlines[future] <= now and not future.done()]:
+            db_adress = futures[future][0]
+            pending.discard(future)
+            neo4j_exporter_query_timeouts.labels(query_name).inc()
+            print (strftime("%Y-%m-%d %H:%M:%S", gmtime()) + ' [WARN] The ' + query_name + ' query on ' + db_adress + ' did not finish in time, skipping it')
+            if not future.cancel():
+                with IN_FLIGHT_LOCK:
+                    if IN_FLIGHT.get((query_name, db_adress)) is future:
+                        STUCK_QUERIES.add((query_name, db_adress))
+                reset_driver(query_name, db_adress)
+        if not pending:
+            break
+        # Woken up at least every second to pick up the deadlines of the tasks that have started since
+        done, pending = wait(pending, timeout=max(min(min(deadlines.values()) - now, 1), 0), return_when=FIRST_COMPLETED)
+        for future in done:
             try:
-                global NEO4J_DRIVER
-                NEO4J_DRIVER = GraphDatabase.driver("bolt://"+SERVICE_URL+":7687", auth=None)
-                def neo_query_1():
-                    global NEO4J_DRIVER
-                    with NEO4J_DRIVER.session() as session:
-                        result = session.run('SHOW DATABASES YIELD name, address, currentStatus')
-                        neo4j_request_result = [record.data() for record in result]
-                    with open('/tmp/result_db_status', 'wb') as f_file:
-                        pickle.dump(neo4j_request_result, f_file)
-                    print (strftime("%Y-%m-%d %H:%M:%S", gmtime()) + ' [INFO] [+] Database status query completed')
-                p_1 = Process(target=neo_query_1, name='Process_request_1')
-                p_1.start()
-                p_1.join(timeout=QUERY_TIMEOUT)
-                p_1.terminate()
-                with open('/tmp/result_db_status', 'rb') as f_file:
-                    neo4j_request_result = pickle.load(f_file)
+                results[futures[future][0]] = future.result()
             except Exception as e:
-                neo4j_request_result = []
-                print (strftime("%Y-%m-%d %H:%M:%S", gmtime()) + ' [ERROR] Error connecting to the database to get statuses: ' + str(e))
-                print (strftime("%Y-%m-%d %H:%M:%S", gmtime()) + ' [ERROR] ' + traceback.format_exc())
-            for db_list in neo4j_request_result:
-                if db_list['currentStatus'] == 'online':
-                    db_status = 1
-                else:
-                    db_status = 0
-                neo4j_db_status.labels(name=db_list['name'], address=db_list['address'].split('.')[0], currentStatus=db_list['currentStatus'], namespace=POD_NAMESPACE).set(db_status)
-            lst.append(prometheus_client.generate_latest(neo4j_db_status))
-
-            ### Collect performance metrics from primary service ###
-            print (strftime("%Y-%m-%d %H:%M:%S", gmtime()) + ' [INFO] [-] Collecting performance metrics from ' + SERVICE_URL)
-            try:
-                def neo_query_metrics():
-                    global NEO4J_DRIVER
-                    metrics_data = {
-                        'stores': [],
-                        'transactions': {},
-                        'connections': {'total': 0, 'by_connector': {}},
-                        'pool_info': {}
-                    }
-                    with NEO4J_DRIVER.session() as session:
-                        # Get store sizes
-                        result = session.run('SHOW DATABASES YIELD name, store')
-                        store_data = [{'name': record['name'], 'store': record['store']} for record in result]
-                        metrics_data['stores'] = store_data
-
-                        # Get transaction count per database
-                        result = session.run('SHOW TRANSACTIONS YIELD database RETURN database, count(*) as txCount')
-                        tx_data = {record['database']: record['txCount'] for record in result}
-                        metrics_data['transactions'] = tx_data
-
-                        # Get connection statistics
-                        result = session.run('CALL dbms.listConnections() YIELD connectionId, connector RETURN connector, count(connectionId) as count')
-                        conn_data = {record['connector']: record['count'] for record in result}
-                        metrics_data['connections']['by_connector'] = conn_data
-                        metrics_data['connections']['total'] = sum(conn_data.values())
-
-                        # Try to get JMX metrics for page cache and memory
-                        try:
-                            # Page cache metrics
-                            result = session.run("CALL dbms.queryJmx('org.neo4j:instance=kernel#0,name=Page cache') YIELD attributes RETURN attributes")
-                            for record in result:
-                                attrs = record['attributes']
-                                metrics_data['page_cache'] = {
-                                    'hits': attrs.get('Hits', {}).get('value', 0),
-                                    'faults': attrs.get('Faults', {}).get('value', 0),
-                                    'hit_ratio': attrs.get('HitRatio', {}).get('value', 0.0)
-                                }
-                        except Exception:
-                            # JMX might not be available in community edition
-                            pass
-
-                        # Try to get transaction IDs
-                        try:
-                            for db_name in [s['name'] for s in store_data]:
-                                result = session.run(f'SHOW TRANSACTIONS YIELD database, transactionId WHERE database = "{db_name}" RETURN max(transactionId) as maxId')
-                                for record in result:
-                                    if db_name not in metrics_data.get('tx_ids', {}):
-                                        metrics_data['tx_ids'] = {}
-                                    metrics_data['tx_ids'][db_name] = record['maxId'] if record['maxId'] else 0
-                        except Exception:
-                            pass
-
-                    with open('/tmp/result_metrics', 'wb') as f_file:
-                        pickle.dump(metrics_data, f_file)
-                    print (strftime("%Y-%m-%d %H:%M:%S", gmtime()) + ' [INFO] [+] Performance metrics query completed')
-
-                p_metrics = Process(target=neo_query_metrics, name='Process_metrics')
-                p_metrics.start()
-                p_metrics.join(timeout=QUERY_TIMEOUT)
-                p_metrics.terminate()
-                with open('/tmp/result_metrics', 'rb') as f_file:
-                    metrics_data = pickle.load(f_file)
-
-                # Process store format information
-                for store_info in metrics_data.get('stores', []):
-                    db_name = store_info['name']
-                    store_format = str(store_info.get('store', 'unknown'))
-                    # Set to 1 for the current format, creates a label for tracking format versions
-                    neo4j_store_format.labels(database=db_name, format=store_format, namespace=POD_NAMESPACE).set(1)
-
-                # Process transaction counts (active transactions)
-                for db_name, tx_count in metrics_data.get('transactions', {}).items():
-                    neo4j_transaction_active.labels(database=db_name, namespace=POD_NAMESPACE).set(tx_count)
-
-                # Process transaction IDs
-                for db_name, tx_id in metrics_data.get('tx_ids', {}).items():
-                    neo4j_transaction_last_id.labels(database=db_name, namespace=POD_NAMESPACE).set(tx_id)
-
-                # Process connection statistics by connector
-                for connector, count in metrics_data.get('connections', {}).get('by_connector', {}).items():
-                    neo4j_bolt_connections_active.labels(connector=connector, namespace=POD_NAMESPACE).set(count)
-
-                # Total connections
-                conn_total = metrics_data.get('connections', {}).get('total', 0)
-                neo4j_bolt_connections_total.labels(namespace=POD_NAMESPACE).set(conn_total)
-
-                # Process page cache metrics if available
-                if 'page_cache' in metrics_data:
-                    pc = metrics_data['page_cache']
-                    neo4j_page_cache_hits.labels(database='system', namespace=POD_NAMESPACE).set(pc.get('hits', 0))
-                    neo4j_page_cache_faults.labels(database='system', namespace=POD_NAMESPACE).set(pc.get('faults', 0))
-                    neo4j_page_cache_hit_ratio.labels(database='system', namespace=POD_NAMESPACE).set(pc.get('hit_ratio', 0.0))
+                print (strftime("%Y-%m-%d %H:%M:%S", gmtime()) + ' [ERROR] Error running the ' + query_name + ' query on ' + futures[future][0] + ': ' + str(e))
+    return results
+
+def query_service(name, query, timeout, log_errors=True):
+    """Running a query on the primary service with the same client-side deadline as the nodes.
+    Returns its records, or None when it failed or didn't answer in time"""
+    tasks = {SERVICE_URL: (run_query, (SERVICE_URL, SERVICE_URL, name, query, timeout, log_errors))}
+    return fan_out(name, tasks, timeout + QUERY_GRACE, monotonic() + timeout + QUERY_GRACE).get(SERVICE_URL)
+
+### Metric families, every one is collected on its own schedule ###
+
+def collect_databases(timeout):
+    """Getting the status and the store format of all databases from the primary service with a single query"""
+    print (strftime("%Y-%m-%d %H:%M:%S", gmtime()) + ' [INFO] [-] Getting the statuses of all tables in the cluster')
+    neo4j_request_result = query_service('databases', 'SHOW DATABASES YIELD name, address, currentStatus, store', timeout)
+    db_status = {}
+    store_format = {}
+    for db_list in neo4j_request_result or []:
+        db_status[(db_list['name'], db_list['address'].split('.')[0], db_list['currentStatus'], POD_NAMESPACE)] = 1 if db_list['currentStatus'] == 'online' else 0
+        # Set to 1 for the current format, creates a label for tracking format versions
+        store_format[(db_list['name'], str(db_list.get('store', 'unknown')), POD_NAMESPACE)] = 1
+    update_gauge(neo4j_db_status, db_status)
+    update_gauge(neo4j_store_format, store_format)
+    if neo4j_request_result is not None:
+        print (strftime("%Y-%m-%d %H:%M:%S", gmtime()) + ' [INFO] [+] Database status query completed')
+
+def collect_connections(timeout):
+    """Getting the Bolt connection statistics from the primary service"""
+    result = query_service('connections', 'CALL dbms.listConnections() YIELD connectionId, connector RETURN connector, count(connectionId) as count', timeout)
+    conn_data = {record['connector']: record['count'] for record in result or []}
+    update_gauge(neo4j_bolt_connections_active, {(connector, POD_NAMESPACE): count for connector, count in conn_data.items()})
+    update_gauge(neo4j_bolt_connections_total, {(POD_NAMESPACE,): sum(conn_data.values())} if result is not None else {})
+
+def collect_page_cache(timeout):
+    """Getting the page cache metrics, JMX might not be available in community edition"""
+    result = query_service('page_cache', "CALL dbms.queryJmx('org.neo4j:instance=kernel#0,name=Page cache') YIELD attributes RETURN attributes", timeout, log_errors=False)
+    pc = {}
+    for record in result or []:
+        attrs = record['attributes']
+        pc = {
+            'hits': attrs.get('Hits', {}).get('value', 0),
+            'faults': attrs.get('Faults', {}).get('value', 0),
+            'hit_ratio': attrs.get('HitRatio', {}).get('value', 0.0)
+        }
+    update_gauge(neo4j_page_cache_hits, {('system', POD_NAMESPACE): pc['hits']} if pc else {})
+    update_gauge(neo4j_page_cache_faults, {('system', POD_NAMESPACE): pc['faults']} if pc else {})
+    update_gauge(neo4j_page_cache_hit_ratio, {('system', POD_NAMESPACE): pc['hit_ratio']} if pc else {})
+
+def query_transactions(db_adress, host, timeout):
+    """Getting the transaction count, the last transaction ID and the long queries of every database of a single node.
+    All the databases are aggregated by one SHOW TRANSACTIONS and split by database on the server"""
+    print (strftime("%Y-%m-%d %H:%M:%S", gmtime()) + ' [INFO] [-] Getting transactions and long queries from ' + db_adress)
+    neo4j_request_result = run_query(db_adress, host, 'transactions', 'SHOW TRANSACTIONS YIELD database, transactionId, currentQueryId, status, activeLockCount, pageHits, elapsedTime, cpuTime, waitTime, idleTime RETURN database, count(*) AS txCount, max(toInteger(last(split(transactionId, "-")))) AS maxId, collect(CASE WHEN elapsedTime.milliseconds > ' + str(SLOW_QUERY_THRESHOLD) + ' THEN {database: database, transactionId: transactionId, currentQueryId: currentQueryId, status: status, activeLockCount: activeLockCount, pageHits: pageHits, elapsedTimeMillis: elapsedTime.milliseconds, cpuTimeMillis: cpuTime.milliseconds, waitTimeMillis: waitTime.milliseconds, idleTimeSeconds: idleTime.seconds} END) AS slowQueries', timeout)
+    if neo4j_request_result is not None:
+        print (strftime("%Y-%m-%d %H:%M:%S", gmtime()) + ' [INFO] [+] Transactions query completed on ' + db_adress)
+    return neo4j_request_result
+
+def get_nodes():
+    """Returning the nodes to collect from and where they were found: the cluster topology read from Neo4j
+    while it's fresh, the environment variables, or the primary service"""
+    topology = TOPOLOGY
+    if topology['nodes'] and monotonic() - topology['time'] < TOPOLOGY_TTL:
+        return topology['nodes'], topology['source']
+    # Collect from discovered nodes via environment variables
+    nodes = discover_nodes()
+    if nodes:
+        return nodes, 'environment'
+    # If no cluster nodes found, collect from primary service
+    print (strftime("%Y-%m-%d %H:%M:%S", gmtime()) + ' [INFO] [-] No cluster nodes found, collecting transactions from primary service: ' + SERVICE_URL)
+    return {SERVICE_URL: SERVICE_URL}, 'service'
+
+def collect_transactions(timeout):
+    """Getting transactions and long queries from all the nodes in parallel"""
+    global NODES_SOURCE
+    # The first run starts with the topology, it waits for it so that the nodes aren't renamed on the next run
+    TOPOLOGY_READY.wait(2 * (SCHEDULE['topology']['timeout'] + QUERY_GRACE))
+    nodes, source = get_nodes()
+    renamed = NODES_SOURCE is not None and source != NODES_SOURCE
+    NODES_SOURCE = source
+    update_gauge(neo4j_exporter_cluster_nodes, {(source,): len(nodes)})
+    prune_drivers(set(nodes) | {SERVICE_URL})
+    tasks = {db_adress: (query_transactions, (db_adress, host, timeout)) for db_adress, host in nodes.items()}
+    results = fan_out('transactions', tasks, timeout + QUERY_GRACE, monotonic() + CYCLE_DEADLINE)
+
+    # Nodes that missed the deadline are skipped, the finished ones are still published
+    tx_count = {}
+    tx_ids = {}
+    node_slow_queries = {}
+    for db_adress in nodes:
+        node_result = results.get(db_adress)
+        if node_result is None:
+            node_slow_queries[db_adress] = None
+            continue
+        node_slow_queries[db_adress] = []
+        for record in node_result:
+            # Every node runs its own transactions, the cluster-wide values are the sum and the maximum
+            tx_count[record['database']] = tx_count.get(record['database'], 0) + record['txCount']
+            tx_ids[record['database']] = max(tx_ids.get(record['database'], 0), record['maxId'] or 0)
+            node_slow_queries[db_adress].extend(record['slowQueries'])
+    update_gauge(neo4j_transaction_active, {(db_name, POD_NAMESPACE): count for db_name, count in tx_count.items()})
+    update_gauge(neo4j_transaction_last_id, {(db_name, POD_NAMESPACE): tx_id for db_name, tx_id in tx_ids.items()})
+
+    slow_queries = {}
+    slow_queries_page_hits = {}
+    for db_adress, node_result in node_slow_queries.items():
+        if SLOW_QUERY_MODE not in ('labels', 'both'):
+            break
+        for db_list in node_result or []:
+            slow_queries[(db_list['database'], db_list['transactionId'], db_list['currentQueryId'], db_list['status'], db_list['activeLockCount'], db_list['pageHits'], db_list['cpuTimeMillis'], db_list['waitTimeMillis'], db_list['idleTimeSeconds'], POD_NAMESPACE, db_adress)] = db_list['elapsedTimeMillis']
+            slow_queries_page_hits[(db_list['database'], db_list['transactionId'], db_list['currentQueryId'], db_list['status'], db_list['activeLockCount'], db_list['cpuTimeMillis'], db_list['waitTimeMillis'], db_list['idleTimeSeconds'], POD_NAMESPACE, db_adress)] = db_list['pageHits']
+    update_gauge(neo4j_db_slow_queries, slow_queries)
+    update_gauge(neo4j_db_slow_queries_page_hits, slow_queries_page_hits)
+    if SLOW_QUERY_MODE in ('aggregate', 'both'):
+        update_slow_query_aggregates(node_slow_queries, renamed)
+
+def family_schedule(name, collect, interval, timeout, timeout_variable=None):
+    """Reading the schedule of a metric family, can be overridden with COLLECT_<NAME>_INTERVAL/_JITTER/_TIMEOUT.
+    The timeout is read from timeout_variable instead when it's given"""
+    prefix = 'COLLECT_' + name.upper()
+    interval = int(os.environ.get(prefix + '_INTERVAL', str(interval)))
+    return {
+        'collect': collect,
+        'interval': interval,
+        'jitter': int(os.environ.get(prefix + '_JITTER', str(interval // 10))),
+        'timeout': int(os.environ.get(timeout_variable or prefix + '_TIMEOUT', str(timeout))),
+    }
+
+SCHEDULE = {
+    'topology': family_schedule('topology', collect_topology, 300, QUERY_TIMEOUT),
+    'databases': family_schedule('databases', collect_databases, 60, QUERY_TIMEOUT),
+    'connections': family_schedule('connections', collect_connections, 30, QUERY_TIMEOUT),
+    'page_cache': family_schedule('page_cache', collect_page_cache, 60, QUERY_TIMEOUT),
+    # Deadline for collecting transactions from a single node in seconds, also the Neo4j timeout of its query
+    'transactions': family_schedule('transactions', collect_transactions, 30, QUERY_TIMEOUT, 'NODE_TIMEOUT'),
+}
+# Deadline for collecting transactions from all the nodes, a run never lasts longer than the interval
+CYCLE_DEADLINE = min(CYCLE_TIMEOUT, SCHEDULE['transactions']['interval'])
+# The deadline of a node (NODE_TIMEOUT and QUERY_GRACE) has to fit in the cycle, otherwise the cycle deadline always fires first
+if SCHEDULE['transactions']['timeout'] + QUERY_GRACE > CYCLE_DEADLINE:
+    if 'NODE_TIMEOUT' in os.environ:
+        print (strftime("%Y-%m-%d %H:%M:%S", gmtime()) + ' [WARN] NODE_TIMEOUT ' + str(SCHEDULE['transactions']['timeout']) + ' and QUERY_GRACE ' + str(QUERY_GRACE) + ' exceed the cycle deadline of ' + str(CYCLE_DEADLINE) + ' seconds, using NODE_TIMEOUT ' + str(max(CYCLE_DEADLINE - QUERY_GRACE, 1)))
+    SCHEDULE['transactions']['timeout'] = max(CYCLE_DEADLINE - QUERY_GRACE, 1)
+# Families being collected right now, a family is never run twice at the same time
+RUNNING_FAMILIES = set()
+RUNNING_FAMILIES_LOCK = threading.Lock()
+RENDER_LOCK = threading.Lock()
+FAMILY_POOL = ThreadPoolExecutor(max_workers=len(SCHEDULE), thread_name_prefix='family')
+
+def render_snapshot():
+    """Rendering the registry into a new snapshot and publishing it with one assignment"""
+    global SNAPSHOT
+    with RENDER_LOCK:
+        neo4j_exporter_snapshot_timestamp.set(time())
+        SNAPSHOT = {
+            'serial': SNAPSHOT['serial'] + 1,
+            'time': time(),
+            # The age of the snapshot is appended when serving, so the OpenMetrics end marker is left out
+            'bodies': {'text': prometheus_client.generate_latest(REGISTRY), 'openmetrics': openmetrics.generate_latest(REGISTRY).removesuffix(b'# EOF\n')},
+            'gzip': {},
+            'lock': threading.Lock(),
+        }
+
+def snapshot_gzip(snapshot, body_format):
+    """Returning the gzip-compressed body of the snapshot, it's compressed once for all the requests"""
+    with snapshot['lock']:
+        if body_format not in snapshot['gzip']:
+            snapshot['gzip'][body_format] = gzip.compress(snapshot['bodies'][body_format], compresslevel=6)
+    return snapshot['gzip'][body_format]
+
+def run_family(name):
+    """Collecting one metric family and publishing the refreshed metrics"""
+    started = time()
+    start = monotonic()
+    try:
+        SCHEDULE[name]['collect'](SCHEDULE[name]['timeout'])
+        collected = monotonic()
+        neo4j_exporter_collection_duration.labels(name).observe(collected - start)
+        ### Final set of metrics, rendered once and swapped in one assignment ###
+        render_snapshot()
+        with TIMINGS_LOCK:
+            FAMILY_TIMINGS[name] = {'started': started, 'collect': collected - start, 'render': monotonic() - collected}
+    except Exception as e:
+        print (strftime("%Y-%m-%d %H:%M:%S", gmtime()) + ' [ERROR] Error collecting ' + name + ': ' + str(e))
+        print (strftime("%Y-%m-%d %H:%M:%S", gmtime()) + ' [ERROR] ' + traceback.format_exc())
+    finally:
+        with RUNNING_FAMILIES_LOCK:
+            RUNNING_FAMILIES.discard(name)
 
-            except Exception as e:
-                print (strftime("%Y-%m-%d %H:%M:%S", gmtime()) + ' [ERROR] Error collecting performance metrics: ' + str(e))
-                print (strftime("%Y-%m-%d %H:%M:%S", gmtime()) + ' [ERROR] ' + traceback.format_exc())
-
-            lst.append(prometheus_client.generate_latest(neo4j_transaction_active))
-            lst.append(prometheus_client.generate_latest(neo4j_transaction_last_id))
-            lst.append(prometheus_client.generate_latest(neo4j_bolt_connections_active))
-            lst.append(prometheus_client.generate_latest(neo4j_bolt_connections_total))
-            lst.append(prometheus_client.generate_latest(neo4j_page_cache_hits))
-            lst.append(prometheus_client.generate_latest(neo4j_page_cache_faults))
-            lst.append(prometheus_client.generate_latest(neo4j_page_cache_hit_ratio))
-            lst.append(prometheus_client.generate_latest(neo4j_store_format))
-
-            ### Long-running queries ###
-            neo4j_db_slow_queries = Gauge('neo4j_db_slow_query', 'Queries that have been running for more than 10,000 milliseconds', ['database', 'transactionId', 'currentQueryId', 'status', 'activeLockCount', 'pageHits', 'cpuTimeMillis', 'waitTimeMillis', 'idleTimeSeconds', 'namespace', 'address'], registry=registry)
-            neo4j_db_slow_queries_page_hits = Gauge('neo4j_db_slow_query_page_hits', 'Page hits amount of queries that have been running for more than 10,000 milliseconds', ['database', 'transactionId', 'currentQueryId', 'status', 'activeLockCount', 'cpuTimeMillis', 'waitTimeMillis', 'idleTimeSeconds', 'namespace', 'address'], registry=registry)
-
-            # Collect from discovered nodes via environment variables
-            nodes_found = False
-            for key, value in os.environ.items():
-                if ("NEO4J_CORE" in key or "NEO4J_REPLICA" in key) and "PORT_7687_TCP_ADDR" in key and not "ADMIN" in key:
-                    nodes_found = True
-                    db_adress = key.split('_')[0] + '-' + key.split('_')[1] + '-' + key.split('_')[2]
-                    print (strftime("%Y-%m-%d %H:%M:%S", gmtime()) + ' [INFO] [-] Getting long queries from ' + db_adress.lower())
-                    try:
-                        NEO4J_DRIVER = GraphDatabase.driver("bolt://"+str(value)+":7687", auth=None)
-                        def neo_query_2():
-                            global NEO4J_DRIVER
-                            with NEO4J_DRIVER.session() as session:
-                                result = session.run('SHOW TRANSACTIONS YIELD database, transactionId, currentQueryId, status, activeLockCount, pageHits, elapsedTime, cpuTime, waitTime, idleTime WHERE elapsedTime.milliseconds > 10000 RETURN database, transactionId, currentQueryId, status, activeLockCount, pageHits, elapsedTime.milliseconds AS elapsedTimeMillis, cpuTime.milliseconds AS cpuTimeMillis, waitTime.milliseconds AS waitTimeMillis, idleTime.seconds AS idleTimeSeconds')
-                                neo4j_request_result = [record.data() for record in result]
-                            with open('/tmp/result_slow_queries', 'wb') as f_file:
-                                pickle.dump(neo4j_request_result, f_file)
-                            print (strftime("%Y-%m-%d %H:%M:%S", gmtime()) + ' [INFO] [+] Slow queries query completed')
-                        p_2 = Process(target=neo_query_2, name='Process_request_2')
-                        p_2.start()
-                        p_2.join(timeout=QUERY_TIMEOUT)
-                        p_2.terminate()
-                        with open('/tmp/result_slow_queries', 'rb') as f_file:
-                            neo4j_request_result = pickle.load(f_file)
-                    except Exception as e:
-                        neo4j_request_result = []
-                        print (strftime("%Y-%m-%d %H:%M:%S", gmtime()) + ' [ERROR] Error connecting to the ' + db_adress.lower() + ' to get long queries: ' + str(e))
-                        print (strftime("%Y-%m-%d %H:%M:%S", gmtime()) + ' [ERROR] ' + traceback.format_exc())
-                    for db_list in neo4j_request_result:
-                        neo4j_db_slow_queries.labels(database=db_list['database'], transactionId=db_list['transactionId'], currentQueryId=db_list['currentQueryId'], status=db_list['status'], activeLockCount=db_list['activeLockCount'], pageHits=db_list['pageHits'], cpuTimeMillis=db_list['cpuTimeMillis'], waitTimeMillis=db_list['waitTimeMillis'], idleTimeSeconds=db_list['idleTimeSeconds'], namespace=POD_NAMESPACE, address=db_adress.lower()).set(db_list['elapsedTimeMillis'])
-                        neo4j_db_slow_queries_page_hits.labels(database=db_list['database'], transactionId=db_list['transactionId'], currentQueryId=db_list['currentQueryId'], status=db_list['status'], activeLockCount=db_list['activeLockCount'], cpuTimeMillis=db_list['cpuTimeMillis'], waitTimeMillis=db_list['waitTimeMillis'], idleTimeSeconds=db_list['idleTimeSeconds'], namespace=POD_NAMESPACE, address=db_adress.lower()).set(db_list['pageHits'])
-
-            # If no cluster nodes found, collect from primary service
-            if not nodes_found:
-                print (strftime("%Y-%m-%d %H:%M:%S", gmtime()) + ' [INFO] [-] No cluster nodes found, collecting long queries from primary service: ' + SERVICE_URL)
-                try:
-                    NEO4J_DRIVER = GraphDatabase.driver("bolt://"+SERVICE_URL+":7687", auth=None)
-                    def neo_query_2_primary():
-                        global NEO4J_DRIVER
-                        with NEO4J_DRIVER.session() as session:
-                            result = session.run('SHOW TRANSACTIONS YIELD database, transactionId, currentQueryId, status, activeLockCount, pageHits, elapsedTime, cpuTime, waitTime, idleTime WHERE elapsedTime.milliseconds > 10000 RETURN database, transactionId, currentQueryId, status, activeLockCount, pageHits, elapsedTime.milliseconds AS elapsedTimeMillis, cpuTime.milliseconds AS cpuTimeMillis, waitTime.milliseconds AS waitTimeMillis, idleTime.seconds AS idleTimeSeconds')
-                            neo4j_request_result = [record.data() for record in result]
-                        with open('/tmp/result_slow_queries_primary', 'wb') as f_file:
-                            pickle.dump(neo4j_request_result, f_file)
-                        print (strftime("%Y-%m-%d %H:%M:%S", gmtime()) + ' [INFO] [+] Slow queries query completed')
-                    p_2_primary = Process(target=neo_query_2_primary, name='Process_request_2_primary')
-                    p_2_primary.start()
-                    p_2_primary.join(timeout=QUERY_TIMEOUT)
-                    p_2_primary.terminate()
-                    with open('/tmp/result_slow_queries_primary', 'rb') as f_file:
-                        neo4j_request_result = pickle.load(f_file)
-                    for db_list in neo4j_request_result:
-                        neo4j_db_slow_queries.labels(database=db_list['database'], transactionId=db_list['transactionId'], currentQueryId=db_list['currentQueryId'], status=db_list['status'], activeLockCount=db_list['activeLockCount'], pageHits=db_list['pageHits'], cpuTimeMillis=db_list['cpuTimeMillis'], waitTimeMillis=db_list['waitTimeMillis'], idleTimeSeconds=db_list['idleTimeSeconds'], namespace=POD_NAMESPACE, address=SERVICE_URL).set(db_list['elapsedTimeMillis'])
-                        neo4j_db_slow_queries_page_hits.labels(database=db_list['database'], transactionId=db_list['transactionId'], currentQueryId=db_list['currentQueryId'], status=db_list['status'], activeLockCount=db_list['activeLockCount'], cpuTimeMillis=db_list['cpuTimeMillis'], waitTimeMillis=db_list['waitTimeMillis'], idleTimeSeconds=db_list['idleTimeSeconds'], namespace=POD_NAMESPACE, address=SERVICE_URL).set(db_list['pageHits'])
-                except Exception as e:
-                    print (strftime("%Y-%m-%d %H:%M:%S", gmtime()) + ' [ERROR] Error getting long queries from primary service: ' + str(e))
-                    print (strftime("%Y-%m-%d %H:%M:%S", gmtime()) + ' [ERROR] ' + traceback.format_exc())
-
-            lst.append(prometheus_client.generate_latest(neo4j_db_slow_queries))
-            lst.append(prometheus_client.generate_latest(neo4j_db_slow_queries_page_hits))
-
-            ### Final set of metrics ###
-            global PROM_OUTPUT
-            PROM_OUTPUT = lst
-            print(strftime("%Y-%m-%d %H:%M:%S", gmtime()) + ' [INFO] Prometheus metrics have been successfully collected in the background')
-
-            BACKGROUND_CHECK = False
-
-        threading.Timer(240, background_collector).start()
-
-background_collector()
+def background_collector():
+    """Collecting Neo4j metrics in the background, every family is started when it is due"""
+    print(strftime("%Y-%m-%d %H:%M:%S", gmtime()) + ' [INFO] The task of background collection of metrics has been successfully created')
+    # The first collection of every family starts right away
+    next_run = {name: monotonic() for name in SCHEDULE}
+    while True:
+        for name, schedule in SCHEDULE.items():
+            now = monotonic()
+            if next_run[name] > now:
+                continue
+            next_run[name] = now + schedule['interval'] + random.uniform(0, schedule['jitter'])
+            with RUNNING_FAMILIES_LOCK:
+                if name in RUNNING_FAMILIES:
+                    neo4j_exporter_skipped_runs.labels(name).inc()
+                    print(strftime("%Y-%m-%d %H:%M:%S", gmtime()) + ' [WARN] The previous collection of ' + name + ' is still running, skipping the current run')
+                    continue
+                RUNNING_FAMILIES.add(name)
+            FAMILY_POOL.submit(run_family, name)
+        sleep(max(min(next_run.values()) - monotonic(), 0))
+
+threading.Thread(target=background_collector, name='background_collector', daemon=True).start()
 
 @app.route("/")
 def hello():
@@ -290,8 +602,38 @@ def hello():
 
 @app.route('/metrics', methods=['GET'])
 def metrics():
-    """Displaying the Prometheus Metrics page"""
-    return Response(PROM_OUTPUT,mimetype=CONTENT_TYPE_LATEST)
+    """Displaying the Prometheus Metrics page from the last snapshot.
+    Supports OpenMetrics, gzip and If-None-Match, the body is skipped while the snapshot is unchanged"""
+    snapshot = SNAPSHOT
+    if 'application/openmetrics-text' in [accepted.split(';')[0].strip() for accepted in request.headers.get('Accept', '').split(',')]:
+        body_format, content_type, tail = 'openmetrics', openmetrics.CONTENT_TYPE_LATEST, openmetrics.generate_latest(SNAPSHOT_REGISTRY)
+    else:
+        body_format, content_type, tail = 'text', CONTENT_TYPE_LATEST, prometheus_client.generate_latest(SNAPSHOT_REGISTRY)
+    use_gzip = request.accept_encodings['gzip'] > 0
+    etag = str(snapshot['serial']) + '-' + body_format + ('-gzip' if use_gzip else '')
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    elif use_gzip:
+        # Concatenated gzip members are a valid gzip stream, only the small tail is compressed per request
+        response = Response(snapshot_gzip(snapshot, body_format) + gzip.compress(tail, compresslevel=6), content_type=content_type)
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = Response(snapshot['bodies'][body_format] + tail, content_type=content_type)
+    # The appended age changes on every request, so the body is only the same semantically: the ETag is weak
+    response.set_etag(etag, weak=True)
+    response.vary.update(('Accept', 'Accept-Encoding'))
+    return response
+
+@app.route('/debug/timings', methods=['GET'])
+def timings():
+    """Displaying the timings of the last collection of every family and query, enabled by PROFILING_ENDPOINT"""
+    if not PROFILING_ENDPOINT:
+        return Response('Set PROFILING_ENDPOINT=true to enable this page', status=404)
+    # The collector threads keep adding timings, the page is made from copies
+    with TIMINGS_LOCK:
+        copies = {'families': dict(FAMILY_TIMINGS), 'queries': dict(QUERY_TIMINGS)}
+    return jsonify(copies)
 
 if __name__ == "__main__":
-    app.run(debug=True)
+    from waitress import serve
+    serve(app, host='0.0.0.0', port=HTTP_PORT, threads=HTTP_THREADS)